@@ -11,7 +11,8 @@ Uses WSGI, see http://docs.python.org/library/wsgiref.html
 Python 2 or Python 3
 """
 
-import cgi
+import gzip
+import io
 import os
 try:
     import json
@@ -24,6 +25,13 @@ from pprint import pprint
 import socket
 import struct
 import sys
+import threading
+import time
+import zlib
+try:
+    from urlparse import parse_qs  # Python 2
+except ImportError:
+    from urllib.parse import parse_qs  # Python 3 - cgi.parse_qs was removed in 3.8
 from wsgiref.simple_server import make_server
 
 
@@ -42,6 +50,7 @@ def force_bool(in_bool):
 
 ALWAYS_RETURN_404 = force_bool(os.environ.get('ALWAYS_RETURN_404', True))
 DEFAULT_SERVER_PORT = 8000
+CAPTURE_FILENAME = os.environ.get('CAPTURE_FILENAME')  # if set, record all request/response pairs, see CaptureMiddleware
 
 
 log = logging.getLogger(__name__)
@@ -221,7 +230,7 @@ def shaarli_rest_api_wsgi(environ, start_response):
 
     if 'GET' == request_method:
         # Returns a dictionary in which the values are lists
-        get_dict = cgi.parse_qs(environ['QUERY_STRING'])  # FIXME not needed here, defer to later when GET is needed (useless OP when POST/PUT used)
+        get_dict = parse_qs(environ['QUERY_STRING'])  # FIXME not needed here, defer to later when GET is needed (useless OP when POST/PUT used)
 
         if path_info and path_info.startswith('/api/v1/info'):
             # http://shaarli.github.io/api-documentation/#links-instance-information-get
@@ -412,7 +421,7 @@ def shaarli_rest_api_wsgi(environ, start_response):
             print('PATH_INFO %r' % environ['PATH_INFO'])
             print('CONTENT_TYPE %r' % environ['CONTENT_TYPE'])
             print('QUERY_STRING %r' % environ['QUERY_STRING'])
-            print('QUERY_STRING dict %r' % get_dict)
+            print('QUERY_STRING dict %r' % parse_qs(environ['QUERY_STRING']))
             print('REQUEST_METHOD %r' % environ['REQUEST_METHOD'])
             #print('environ %r' % environ) # DEBUG, potentially pretty print, but dumping this is non-default
             #print('environ:') # DEBUG, potentially pretty print, but dumping this is non-default
@@ -439,16 +448,247 @@ def shaarli_rest_api_wsgi(environ, start_response):
     return result
 
 
+# CGI/WSGI environ entries needed to rebuild a request, see replay_capture.py
+CAPTURE_ENVIRON_KEYS = (
+    'REQUEST_METHOD',
+    'SCRIPT_NAME',
+    'PATH_INFO',
+    'QUERY_STRING',
+    'CONTENT_TYPE',
+    'CONTENT_LENGTH',
+    'SERVER_NAME',
+    'SERVER_PORT',
+    'SERVER_PROTOCOL',
+    'wsgi.url_scheme',
+)
+# environ entries masked in captures, so capture files do not hold live credentials (JWT bearer token, etc.)
+CAPTURE_REDACT_KEYS = (
+    'HTTP_AUTHORIZATION',
+    'HTTP_COOKIE',
+)
+CAPTURE_REDACTED = '<redacted>'
+
+
+def open_capture_file(filename, mode='rb'):
+    """Open capture file, gzip compressed if filename ends in .gz"""
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode)
+    return open(filename, mode)
+
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+def iter_gzip_lines(f, chunk_size=64 * 1024):
+    """Generator, returns lines from (multi member) gzip file object f.
+    Unlike gzip.GzipFile, complete lines decompressed before a corrupt
+    or unterminated stream are returned before zlib.error/EOFError is raised.
+    Raises IOError if f is not gzip.
+    """
+    data = f.read(chunk_size)
+    if data and data[:2] != GZIP_MAGIC:
+        raise IOError('Not a gzipped file (%r)' % data[:2])
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    pending = b''
+    while data:
+        backup = decompressor.copy()
+        try:
+            pending += decompressor.decompress(data)
+        except zlib.error:
+            # salvage output before the corruption, a byte at a time
+            decompressor = backup
+            try:
+                for i in range(len(data)):
+                    pending += decompressor.decompress(data[i:i + 1])
+            finally:
+                for line in pending.split(b'\n')[:-1]:
+                    yield line
+        lines = pending.split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line
+        if decompressor.unused_data:
+            # start of next gzip member
+            data = decompressor.unused_data
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            data = f.read(chunk_size)
+    if not getattr(decompressor, 'eof', True):  # Python 2 has no eof attribute
+        raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+    if pending:
+        yield pending
+
+
+def read_capture(filename):
+    """Generator, returns capture records (dictionaries) written by CaptureMiddleware
+
+    Tolerates only what a killed server leaves behind; an unterminated
+    (or truncated) gzip stream and a partially written final line. Reading
+    stops at the last complete record and a warning is logged. Anything
+    else, e.g. not a gzip file or a bad record before the final line, raises.
+    """
+    f = open(filename, 'rb')
+    if filename.endswith('.gz'):
+        lines = iter_gzip_lines(f)
+    else:
+        lines = f
+    record_count = 0
+    line_number = 0
+    bad_line_number = None
+    try:
+        try:
+            for line in lines:
+                line_number += 1
+                line = line.strip()
+                if not line:
+                    continue
+                if bad_line_number is not None:
+                    raise ValueError('%s: invalid capture record on line %d' % (filename, bad_line_number))
+                try:
+                    record = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    bad_line_number = line_number  # only acceptable if this is the final line
+                    continue
+                record_count += 1
+                yield record
+        except (EOFError, zlib.error) as info:
+            # gzip stream not terminated, server was killed. Records are flushed as written
+            log.warning('%s: capture truncated (%r), read %d records', filename, info, record_count)
+            return
+        if bad_line_number is not None:
+            log.warning('%s: ignored incomplete final line %d, read %d records', filename, bad_line_number, record_count)
+    finally:
+        f.close()
+
+
+class CaptureMiddleware:
+    """WSGI middleware that records every request/response pair (with timings)
+    to a JSON Lines file, one compact JSON object per line. Use a filename
+    ending in .gz for gzip compression. The file is overwritten on start
+    (appending to a gzip stream left unterminated by a killed server makes
+    the whole file unreadable). Captured sessions can be replayed
+    with replay_capture.py
+
+    Sample record (bodies are latin1 decoded, so round trip is lossless):
+
+        {
+            "t": 1648420000.25,  # request start, seconds since epoch
+            "duration": 0.002,  # seconds spent in the wrapped application
+            "request": {
+                "environ": {"REQUEST_METHOD": "GET", "PATH_INFO": "/api/v1/tags", "HTTP_HOST": "...", ...},
+                "body": ""
+            },
+            "response": {
+                "status": "200 OK",
+                "headers": [["Content-type", "application/json"]],
+                "body": "[]"
+            }
+        }
+
+    If the application raises an exception "response" is null and "error"
+    holds repr() of the exception. HTTP_AUTHORIZATION and HTTP_COOKIE are
+    redacted.
+    """
+    def __init__(self, application, filename):
+        self.application = application
+        self.filename = filename
+        self.capture_file = open_capture_file(filename, 'wb')
+        self.lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        request_start = time.time()
+
+        # the environment variable CONTENT_LENGTH may be empty or missing
+        try:
+            request_body_size = int(environ.get('CONTENT_LENGTH', 0))
+        except (ValueError):
+            request_body_size = 0
+        request_body = environ['wsgi.input'].read(request_body_size)
+        environ['wsgi.input'] = io.BytesIO(request_body)  # application still needs to read the body
+
+        captured_environ = {}
+        for key in environ:
+            if key in CAPTURE_REDACT_KEYS:
+                captured_environ[key] = CAPTURE_REDACTED
+            elif key in CAPTURE_ENVIRON_KEYS or key.startswith('HTTP_'):
+                captured_environ[key] = environ[key]
+
+        response = {}
+        def capture_start_response(status, response_headers, exc_info=None):
+            response['status'] = status
+            response['headers'] = response_headers
+            if exc_info:
+                return start_response(status, response_headers, exc_info)
+            return start_response(status, response_headers)
+
+        record = {
+            't': round(request_start, 6),
+            'request': {
+                'environ': captured_environ,
+                'body': request_body.decode('latin1'),
+            },
+        }
+        try:
+            result = self.application(environ, capture_start_response)
+            try:
+                response_body = b''.join(result)
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        except Exception as info:
+            # still record the request, unknown clients are what capture is for
+            record['duration'] = round(time.time() - request_start, 6)
+            record['response'] = None
+            record['error'] = repr(info)
+            self.write_record(record)
+            raise
+        record['duration'] = round(time.time() - request_start, 6)
+        record['response'] = {
+            'status': response.get('status'),
+            'headers': response.get('headers'),
+            'body': response_body.decode('latin1'),
+        }
+        self.write_record(record)
+
+        return [response_body]
+
+    def write_record(self, record):
+        """Write record to capture file, failures are logged (never raised)
+        so a capture problem can not turn a good request into a 500
+        """
+        try:
+            line = json.dumps(record, separators=(',', ':'))
+            self.lock.acquire()
+            try:
+                self.capture_file.write(to_bytes(line + '\n'))
+                self.capture_file.flush()
+            finally:
+                self.lock.release()
+        except Exception:
+            log.exception('%s: failed to write capture record', self.filename)
+
+    def close(self):
+        self.capture_file.close()
+
+
 def main(argv=None):
     print('Python %s on %s' % (sys.version, sys.platform))
     server_port = int(os.environ.get('PORT', DEFAULT_SERVER_PORT))
 
-    httpd = make_server('', server_port, shaarli_rest_api_wsgi)
+    application = shaarli_rest_api_wsgi
+    if CAPTURE_FILENAME:
+        application = CaptureMiddleware(application, CAPTURE_FILENAME)
+    httpd = make_server('', server_port, application)
     print("Serving on port %d..." % server_port)
     print("ALWAYS_RETURN_404 = %r" % ALWAYS_RETURN_404)
+    print("CAPTURE_FILENAME = %r" % CAPTURE_FILENAME)
     local_ip = determine_local_ipaddr()
     log.info('Starting server: %r', (local_ip, server_port))
-    httpd.serve_forever()
+    try:
+        httpd.serve_forever()
+    finally:
+        if CAPTURE_FILENAME:
+            application.close()
 
 if __name__ == "__main__":
     sys.exit(main())
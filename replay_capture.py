@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+# -*- coding: us-ascii -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+#
+# replay_capture.py - Replay captured Shaarli REST API sessions
+# Copyright (C) 2022  Chris Clark
+"""Replay a session recorded by fake_shaarli_server.py (CAPTURE_FILENAME)
+against a dispatcher, in process (no network), to reproduce real client
+load and find hot spots offline.
+
+Python 2 or Python 3
+
+    CAPTURE_FILENAME=capture.jsonl.gz python fake_shaarli_server.py  # record
+    python replay_capture.py capture.jsonl.gz  # replay, as fast as possible
+    python replay_capture.py capture.jsonl.gz --speedup 10 --concurrency 4
+    python replay_capture.py capture.jsonl.gz --quiet --cprofile --cprofile-output replay.prof --tracemalloc
+    python replay_capture.py capture.jsonl.gz --dispatcher shaarli2linkding_proxy:dispatcher_from_environ
+"""
+
+import argparse
+import importlib
+import io
+import os
+import sys
+import threading
+import time
+try:
+    import Queue as queue  # Python 2
+except ImportError:
+    import queue  # Python 3
+from wsgiref.util import setup_testing_defaults
+
+try:
+    import cProfile
+    import pstats
+except ImportError:
+    cProfile = None
+try:
+    import tracemalloc  # Python 3.4+
+except ImportError:
+    tracemalloc = None
+
+import fake_shaarli_server  # https://github.com/clach04/fake-shaarli-server
+
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+def load_dispatcher(dispatcher_name):
+    """Import dispatcher from "module:attribute" string.
+    If attribute is callable (e.g. a class or factory function) it is called,
+    with no arguments, to create the dispatcher instance.
+    """
+    module_name, attribute_name = dispatcher_name.split(':', 1)
+    module = importlib.import_module(module_name)
+    dispatcher = getattr(module, attribute_name)
+    if callable(dispatcher):
+        dispatcher = dispatcher()
+    return dispatcher
+
+
+class ProfilingDispatcher:
+    """Wrap a dispatcher, recording call count and time per method.
+    Optionally runs each dispatcher call under cProfile and/or records
+    net memory allocated (tracemalloc). Profilers are process wide, other
+    threads running at the same time would be counted too, so only use
+    them with concurrency 1 (main() enforces this).
+    """
+    def __init__(self, dispatcher, profiler=None, trace_memory=False):
+        self.dispatcher = dispatcher
+        self.profiler = profiler
+        self.trace_memory = trace_memory
+        self.serialize = profiler is not None or trace_memory
+        self.lock = threading.Lock()
+        self.stats = {}  # method name -> [calls, seconds, bytes]
+
+    def __getattr__(self, name):
+        attr = getattr(self.dispatcher, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        def wrapper(*args, **kwargs):
+            if self.serialize:
+                self.lock.acquire()
+            try:
+                if self.trace_memory:
+                    memory_before = tracemalloc.get_traced_memory()[0]
+                if self.profiler:
+                    self.profiler.enable()
+                start = timer()
+                try:
+                    return attr(*args, **kwargs)
+                finally:
+                    duration = timer() - start
+                    if self.profiler:
+                        self.profiler.disable()
+                    memory_delta = 0
+                    if self.trace_memory:
+                        memory_delta = tracemalloc.get_traced_memory()[0] - memory_before
+                    self.record(name, duration, memory_delta)
+            finally:
+                if self.serialize:
+                    self.lock.release()
+        return wrapper
+
+    def record(self, name, duration, memory_delta):
+        if not self.serialize:
+            self.lock.acquire()
+        try:
+            method_stats = self.stats.setdefault(name, [0, 0.0, 0])
+            method_stats[0] += 1
+            method_stats[1] += duration
+            method_stats[2] += memory_delta
+        finally:
+            if not self.serialize:
+                self.lock.release()
+
+
+def build_environ(record):
+    """Rebuild WSGI environ from a capture record"""
+    request = record['request']
+    request_body = request['body'].encode('latin1')
+    environ = dict(request['environ'])
+    environ['CONTENT_LENGTH'] = str(len(request_body))
+    environ['wsgi.input'] = io.BytesIO(request_body)
+    environ['wsgi.multithread'] = True
+    setup_testing_defaults(environ)
+    return environ
+
+
+def replay_request(application, record):
+    """Call WSGI application with captured request, returns (status, seconds)"""
+    response = {}
+    def start_response(status, response_headers, exc_info=None):
+        response['status'] = status
+
+    environ = build_environ(record)
+    start = timer()
+    result = application(environ, start_response)
+    try:
+        for _ in result:
+            pass
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return response.get('status'), timer() - start
+
+
+def replay(records, application=fake_shaarli_server.shaarli_rest_api_wsgi, concurrency=1, speedup=0.0):
+    """Replay capture records against WSGI application.
+    speedup of 0 ignores captured timings and sends requests as fast as possible,
+    otherwise captured timings are divided by speedup (1.0 == real time).
+    Returns (wall clock seconds, list of results); each result is a
+    dictionary with keys; record, status, duration, error
+    """
+    work_queue = queue.Queue(maxsize=concurrency * 2)
+    results = []
+    results_lock = threading.Lock()
+
+    def worker():
+        while True:
+            record = work_queue.get()
+            if record is None:
+                break
+            result = {'record': record, 'status': None, 'duration': None, 'error': None}
+            try:
+                result['status'], result['duration'] = replay_request(application, record)
+            except Exception as info:
+                result['error'] = repr(info)
+            results_lock.acquire()
+            try:
+                results.append(result)
+            finally:
+                results_lock.release()
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    first_t = records and records[0].get('t', 0.0) or 0.0
+    start = timer()
+    for record in records:
+        if speedup:
+            delay = (record.get('t', 0.0) - first_t) / speedup - (timer() - start)
+            if delay > 0:
+                time.sleep(delay)
+        work_queue.put(record)
+    for _ in threads:
+        work_queue.put(None)
+    for thread in threads:
+        thread.join()
+    return timer() - start, results
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def captured_outcome(record):
+    """Returns ('error', exception class name) or ('status', status) for a capture record"""
+    if record.get('error'):
+        return 'error', record['error'].split('(', 1)[0]
+    return 'status', (record['response'] or {}).get('status')
+
+
+def replayed_outcome(result):
+    """Returns ('error', exception class name) or ('status', status) for a replay() result"""
+    if result['error']:
+        return 'error', result['error'].split('(', 1)[0]
+    return 'status', result['status']
+
+
+def find_mismatches(results):
+    """Returns replay() results whose outcome differs from the capture"""
+    return [x for x in results if replayed_outcome(x) != captured_outcome(x['record'])]
+
+
+def print_report(wall_seconds, results, dispatcher, out=None):
+    out = out or sys.stdout
+    durations = sorted(x['duration'] for x in results if x['duration'] is not None)
+    errors = [x for x in results if x['error']]
+    mismatches = find_mismatches(results)
+
+    out.write('Requests: %d in %.3f seconds (%.1f requests/sec)\n' % (len(results), wall_seconds, wall_seconds and len(results) / wall_seconds or 0.0))
+    out.write('Errors: %d (%d as captured), mismatches against capture: %d\n' % (len(errors), len([x for x in errors if x not in mismatches]), len(mismatches)))
+    if durations:
+        out.write('Latency seconds: min %.6f mean %.6f median %.6f p95 %.6f max %.6f\n' % (
+            durations[0],
+            sum(durations) / len(durations),
+            percentile(durations, 0.5),
+            percentile(durations, 0.95),
+            durations[-1],
+        ))
+    for result in mismatches[:10]:
+        environ = result['record']['request']['environ']
+        out.write('  mismatch %s %s: %s %r != captured %s %r\n' % ((environ.get('REQUEST_METHOD'), environ.get('PATH_INFO')) + replayed_outcome(result) + captured_outcome(result['record'])))
+        if result['error']:
+            out.write('    %s\n' % result['error'])
+
+    out.write('Dispatcher calls:\n')
+    for name in sorted(dispatcher.stats):
+        calls, seconds, memory_delta = dispatcher.stats[name]
+        line = '  %-20s calls %6d total %.6f mean %.6f seconds' % (name, calls, seconds, seconds / calls)
+        if dispatcher.trace_memory:
+            line += ' net %d bytes' % memory_delta
+        out.write(line + '\n')
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    parser = argparse.ArgumentParser(description='Replay a captured fake_shaarli_server session')
+    parser.add_argument('capture_filename', help='file recorded with CAPTURE_FILENAME, .gz for gzip')
+    parser.add_argument('--dispatcher', help='"module:attribute" dispatcher (or class/factory) to replay against, default fake_shaarli_server.DefaultDispatcher')
+    parser.add_argument('--concurrency', type=int, default=1, help='number of concurrent requests, default %(default)s')
+    parser.add_argument('--speedup', type=float, default=0.0, help='divide captured timings by this, 1 is real time, 0 (default) is as fast as possible')
+    parser.add_argument('--repeat', type=int, default=1, help='number of times to replay the capture, default %(default)s')
+    parser.add_argument('--cprofile', action='store_true', help='profile dispatcher calls with cProfile')
+    parser.add_argument('--cprofile-output', help='save cProfile stats to file, for use with pstats/snakeviz')
+    parser.add_argument('--tracemalloc', action='store_true', help='trace memory allocated by dispatcher calls')
+    parser.add_argument('--quiet', action='store_true', help='discard stdout from server/dispatcher while replaying')
+    options = parser.parse_args(argv)
+
+    if options.cprofile_output:
+        options.cprofile = True
+    if options.cprofile and cProfile is None:
+        parser.error('cProfile not available')
+    if options.tracemalloc and tracemalloc is None:
+        parser.error('tracemalloc not available')
+    if options.dispatcher and ':' not in options.dispatcher:
+        parser.error('--dispatcher must be in "module:attribute" format, got %r' % options.dispatcher)
+    if options.concurrency < 1:
+        parser.error('--concurrency must be 1 or more')
+    if options.repeat < 1:
+        parser.error('--repeat must be 1 or more')
+    if options.concurrency > 1 and (options.cprofile or options.tracemalloc):
+        parser.error('--cprofile and --tracemalloc are process wide and require --concurrency 1')
+
+    records = list(fake_shaarli_server.read_capture(options.capture_filename))
+    records.sort(key=lambda x: x.get('t', 0.0))
+    print('Loaded %d requests from %r' % (len(records), options.capture_filename))
+
+    if options.dispatcher:
+        dispatcher = load_dispatcher(options.dispatcher)
+    else:
+        dispatcher = fake_shaarli_server.DefaultDispatcher()
+    profiler = None
+    if options.cprofile:
+        profiler = cProfile.Profile()
+    if options.tracemalloc:
+        tracemalloc.start()
+    profiling_dispatcher = ProfilingDispatcher(dispatcher, profiler=profiler, trace_memory=options.tracemalloc)
+    fake_shaarli_server.dispatcher = profiling_dispatcher
+
+    original_stdout = sys.stdout
+    if options.quiet:
+        sys.stdout = open(os.devnull, 'w')
+    try:
+        wall_seconds = 0.0
+        results = []
+        for _ in range(options.repeat):
+            run_seconds, run_results = replay(records, concurrency=options.concurrency, speedup=options.speedup)
+            wall_seconds += run_seconds
+            results += run_results
+    finally:
+        if options.quiet:
+            sys.stdout.close()
+            sys.stdout = original_stdout
+
+    if options.tracemalloc:
+        # snapshot before any reporting, so report code does not show up in top allocations
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        excluded_modules = [tracemalloc, sys.modules[__name__]]
+        if cProfile:
+            excluded_modules += [pstats, cProfile]
+        snapshot = snapshot.filter_traces([tracemalloc.Filter(False, x.__file__) for x in excluded_modules])
+
+    print_report(wall_seconds, results, profiling_dispatcher)
+
+    if profiler:
+        if options.cprofile_output:
+            profiler.dump_stats(options.cprofile_output)
+            print('cProfile stats saved to %r' % options.cprofile_output)
+        stats = pstats.Stats(profiler, stream=sys.stdout)
+        stats.sort_stats('cumulative').print_stats(25)
+    if options.tracemalloc:
+        print('tracemalloc current %d bytes, peak %d bytes, top allocations:' % (current, peak))
+        for stat in snapshot.statistics('lineno')[:10]:
+            print('  %s' % stat)
+
+    return find_mismatches(results) and 1 or 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
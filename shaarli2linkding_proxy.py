@@ -187,10 +187,17 @@ class LinkDingDispatcher(fake_shaarli_server.DefaultDispatcher):
         return tag_list
 
 
-def main(argv=None):
+def dispatcher_from_environ():
+    """Create LinkDingDispatcher from LINKDING_URI and LINKDING_TOKEN environment variables
+    Also usable with replay_capture.py --dispatcher shaarli2linkding_proxy:dispatcher_from_environ
+    """
     linkding_uri = os.environ['LINKDING_URI']
     linkding_token = os.environ['LINKDING_TOKEN']
-    fake_shaarli_server.dispatcher = LinkDingDispatcher(linkding_uri, linkding_token)
+    return LinkDingDispatcher(linkding_uri, linkding_token)
+
+
+def main(argv=None):
+    fake_shaarli_server.dispatcher = dispatcher_from_environ()
     fake_shaarli_server.main(argv)
 
 
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- coding: us-ascii -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+#
+# test_capture_replay.py - Tests for CAPTURE_FILENAME capture and replay_capture.py
+# Copyright (C) 2022  Chris Clark
+"""Round trip tests; CaptureMiddleware -> read_capture() -> replay()
+
+Python 2 or Python 3
+
+    python -m unittest test_capture_replay
+"""
+
+import gzip
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from wsgiref.util import setup_testing_defaults
+
+import fake_shaarli_server
+import replay_capture
+
+
+class NullWriter:
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+
+def make_environ(request_method, path_info, body=b'', content_type='application/json', query_string='', extra=None):
+    environ = {
+        'REQUEST_METHOD': request_method,
+        'PATH_INFO': path_info,
+        'QUERY_STRING': query_string,
+        'SCRIPT_NAME': '',
+        'CONTENT_TYPE': content_type,
+        'CONTENT_LENGTH': str(len(body)),
+        'HTTP_HOST': 'localhost:8000',
+        'wsgi.input': io.BytesIO(body),
+    }
+    environ.update(extra or {})
+    setup_testing_defaults(environ)
+    return environ
+
+
+def sample_environs():
+    post_body = json.dumps({'url': 'http://example.com', 'title': 'Example', 'description': '', 'tags': [''], 'private': False}).encode('utf-8')
+    return [
+        make_environ('GET', '/api/v1/info'),
+        make_environ('GET', '/api/v1/tags'),
+        make_environ('GET', '/api/v1/links', query_string='searchterm=http%3A%2F%2Fexample.com&limit=1'),
+        make_environ('POST', '/api/v1/links', body=post_body),
+        make_environ('GET', '/sw.js'),  # unsupported, 404
+    ]
+
+
+def call_application(application, environ):
+    status = []
+    def start_response(response_status, response_headers, exc_info=None):
+        status.append(response_status)
+    body = b''.join(application(environ, start_response))
+    return status[0], body
+
+
+class TestCaptureReplay(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.original_stdout = sys.stdout
+        sys.stdout = NullWriter()  # server and dispatcher are chatty
+
+    def tearDown(self):
+        sys.stdout = self.original_stdout
+        shutil.rmtree(self.temp_dir)
+
+    def capture(self, filename, environs, close=True):
+        application = fake_shaarli_server.CaptureMiddleware(fake_shaarli_server.shaarli_rest_api_wsgi, filename)
+        statuses = [call_application(application, environ)[0] for environ in environs]
+        if close:
+            application.close()
+        return application, statuses
+
+    def test_gzip_round_trip(self):
+        filename = os.path.join(self.temp_dir, 'capture.jsonl.gz')
+        application, statuses = self.capture(filename, sample_environs())
+        records = list(fake_shaarli_server.read_capture(filename))
+
+        self.assertEqual(len(records), 5)
+        self.assertEqual([x['response']['status'] for x in records], statuses)
+        self.assertEqual(statuses[-1], '404 NOT FOUND')
+        self.assertEqual(records[1]['request']['environ']['PATH_INFO'], '/api/v1/tags')
+        self.assertEqual(json.loads(records[3]['request']['body'])['url'], 'http://example.com')
+        self.assertEqual(json.loads(records[3]['response']['body'])['tags'], [])
+        self.assertTrue(records[0]['t'] > 1000000000)  # absolute, seconds since epoch
+        self.assertEqual(sorted(records, key=lambda x: x['t']), records)
+
+    def test_credentials_redacted(self):
+        filename = os.path.join(self.temp_dir, 'capture.jsonl')
+        environ = make_environ('GET', '/api/v1/tags', extra={'HTTP_AUTHORIZATION': 'Bearer secret.jwt.token', 'HTTP_COOKIE': 'session=secret'})
+        self.capture(filename, [environ])
+
+        f = open(filename, 'rb')
+        raw = f.read()
+        f.close()
+        self.assertFalse(b'secret' in raw)
+        captured_environ = list(fake_shaarli_server.read_capture(filename))[0]['request']['environ']
+        self.assertEqual(captured_environ['HTTP_AUTHORIZATION'], fake_shaarli_server.CAPTURE_REDACTED)
+        self.assertEqual(captured_environ['HTTP_COOKIE'], fake_shaarli_server.CAPTURE_REDACTED)
+
+    def test_application_exception_captured(self):
+        filename = os.path.join(self.temp_dir, 'capture.jsonl')
+        application = fake_shaarli_server.CaptureMiddleware(fake_shaarli_server.shaarli_rest_api_wsgi, filename)
+        environ = make_environ('POST', '/jw', body=b'a=1&b=2', content_type='application/x-www-form-urlencoded')
+        self.assertRaises(ValueError, call_application, application, environ)
+        application.close()
+
+        records = list(fake_shaarli_server.read_capture(filename))
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]['response'], None)
+        self.assertTrue('JSONDecodeError' in records[0]['error'] or 'ValueError' in records[0]['error'])
+        self.assertEqual(records[0]['request']['body'], 'a=1&b=2')
+
+    def test_capture_write_failure_does_not_fail_request(self):
+        class FullDisk:
+            def write(self, data):
+                raise IOError(28, 'No space left on device')
+
+            def flush(self):
+                pass
+
+            def close(self):
+                pass
+
+        filename = os.path.join(self.temp_dir, 'capture.jsonl')
+        application = fake_shaarli_server.CaptureMiddleware(fake_shaarli_server.shaarli_rest_api_wsgi, filename)
+        application.capture_file.close()
+        application.capture_file = FullDisk()
+        fake_shaarli_server.log.disabled = True  # expected logged exception
+        try:
+            status, body = call_application(application, make_environ('GET', '/api/v1/tags'))
+        finally:
+            fake_shaarli_server.log.disabled = False
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(body, b'[]')
+
+    def test_killed_then_restarted(self):
+        filename = os.path.join(self.temp_dir, 'capture.jsonl.gz')
+        application, statuses = self.capture(filename, sample_environs()[:2], close=False)
+        # simulate kill; grab file contents before gzip stream is terminated
+        f = open(filename, 'rb')
+        truncated = f.read()
+        f.close()
+        application.close()
+        f = open(filename, 'wb')
+        f.write(truncated)
+        f.close()
+
+        # killed server, stop at last complete record
+        records = list(fake_shaarli_server.read_capture(filename))
+        self.assertEqual([x['request']['environ']['PATH_INFO'] for x in records], ['/api/v1/info', '/api/v1/tags'])
+
+        # new gzip member appended after the unterminated one, records before the corruption are kept
+        f = gzip.open(filename, 'ab')
+        f.write(b'{"t":1}\n')
+        f.close()
+        records = list(fake_shaarli_server.read_capture(filename))
+        self.assertEqual([x['request']['environ']['PATH_INFO'] for x in records], ['/api/v1/info', '/api/v1/tags'])
+
+        # restart, file is overwritten with the new session only
+        self.capture(filename, sample_environs()[3:4])
+        records = list(fake_shaarli_server.read_capture(filename))
+        self.assertEqual([x['request']['environ']['PATH_INFO'] for x in records], ['/api/v1/links'])
+
+    def test_not_gzip_raises(self):
+        filename = os.path.join(self.temp_dir, 'capture.jsonl.gz')
+        f = open(filename, 'wb')
+        f.write(b'{"t":1}\n')
+        f.close()
+        self.assertRaises(IOError, list, fake_shaarli_server.read_capture(filename))
+
+    def test_incomplete_final_line(self):
+        filename = os.path.join(self.temp_dir, 'capture.jsonl')
+        self.capture(filename, sample_environs()[:2])
+        f = open(filename, 'ab')
+        f.write(b'{"t":1234.5,"requ')  # killed mid write
+        f.close()
+        records = list(fake_shaarli_server.read_capture(filename))
+        self.assertEqual([x['request']['environ']['PATH_INFO'] for x in records], ['/api/v1/info', '/api/v1/tags'])
+
+    def test_bad_record_before_final_line_raises(self):
+        filename = os.path.join(self.temp_dir, 'capture.jsonl')
+        self.capture(filename, sample_environs()[:1])
+        f = open(filename, 'ab')
+        f.write(b'not json\n{"t":1234.5}\n')
+        f.close()
+        self.assertRaises(ValueError, list, fake_shaarli_server.read_capture(filename))
+
+    def test_replay_status_matches(self):
+        filename = os.path.join(self.temp_dir, 'capture.jsonl.gz')
+        self.capture(filename, sample_environs())
+        records = list(fake_shaarli_server.read_capture(filename))
+
+        original_dispatcher = fake_shaarli_server.dispatcher
+        dispatcher = replay_capture.ProfilingDispatcher(fake_shaarli_server.DefaultDispatcher())
+        fake_shaarli_server.dispatcher = dispatcher
+        try:
+            wall_seconds, results = replay_capture.replay(records, concurrency=2)
+        finally:
+            fake_shaarli_server.dispatcher = original_dispatcher
+
+        self.assertEqual(len(results), len(records))
+        self.assertEqual([x for x in results if x['error']], [])
+        for result in results:
+            self.assertEqual(result['status'], result['record']['response']['status'])
+        self.assertEqual(replay_capture.find_mismatches(results), [])
+        self.assertEqual(dispatcher.stats['search_tags'][0], 1)
+        self.assertEqual(dispatcher.stats['search_links'][0], 1)
+        self.assertEqual(dispatcher.stats['add_link'][0], 1)
+
+
+    def test_replay_captured_error_is_not_mismatch(self):
+        filename = os.path.join(self.temp_dir, 'capture.jsonl')
+        application = fake_shaarli_server.CaptureMiddleware(fake_shaarli_server.shaarli_rest_api_wsgi, filename)
+        environ = make_environ('POST', '/jw', body=b'a=1&b=2', content_type='application/x-www-form-urlencoded')
+        self.assertRaises(ValueError, call_application, application, environ)
+        call_application(application, make_environ('GET', '/api/v1/tags'))
+        application.close()
+        records = list(fake_shaarli_server.read_capture(filename))
+
+        wall_seconds, results = replay_capture.replay(records)
+        self.assertEqual(len([x for x in results if x['error']]), 1)
+        self.assertEqual(replay_capture.find_mismatches(results), [])
+
+        # outcome differs from capture, in both directions
+        records[0]['error'] = None
+        records[0]['response'] = {'status': '200 OK'}
+        records[1]['error'] = "ValueError('boom')"
+        wall_seconds, results = replay_capture.replay(records)
+        self.assertEqual(len(replay_capture.find_mismatches(results)), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()